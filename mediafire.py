@@ -1,35 +1,76 @@
+import argparse
 import hashlib
+import html
 import re
-import time
-import gazpacho
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import sys
 import threading
+from functools import lru_cache
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CHUNK_SIZE = 1 << 20
+CONNECTION_POOL_SIZE = 64
+FOLDER_CHUNKS_BATCH_SIZE = 4
+REQUEST_TIMEOUT = (5, 30)
+MEDIAFIRE_LINK_REGEX = re.compile(r"mediafire\.com/(folder|file|file_premium)/([a-zA-Z0-9]+)")
+DOWNLOAD_BUTTON_REGEX = re.compile(rb'<a\s[^>]*class="input popsok"[^>]*>')
+HREF_REGEX = re.compile(rb'\shref="([^"]+)"')
+
+
+class FileOrFolderNameTable(dict):
+    """str.translate table, prefilled for Latin-1 and cached lazily beyond it."""
+
+    def __init__(self, allowed_characters: str, replacement: str):
+        super().__init__()
+        self.allowed_characters = allowed_characters
+        self.replacement = replacement
+        self.update((code_point, self._classify(code_point)) for code_point in range(256))
+
+    def _classify(self, code_point: int) -> str:
+        char = chr(code_point)
+        return char if (char.isalnum() or char in self.allowed_characters) else self.replacement
+
+    def __missing__(self, code_point: int) -> str:
+        value = self[code_point] = self._classify(code_point)
+        return value
 
 
 class MediafireDownloader:
     def __init__(self):
         self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTERS = "-_. "
         self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTER_REPLACEMENT = "-"
+        self.file_or_folder_name_table = FileOrFolderNameTable(
+            self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTERS,
+            self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTER_REPLACEMENT,
+        )
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=CONNECTION_POOL_SIZE,
+            pool_maxsize=CONNECTION_POOL_SIZE,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def hash_file(self, filename: str) -> str:
-        h = hashlib.sha256()
-        with open(filename, "rb") as file:
-            chunk = 0
-            while chunk != b"":
-                chunk = file.read(1024)
+        with open(filename, "rb", buffering=0) as file:
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(file, "sha256").hexdigest()
+
+            h = hashlib.sha256()
+            chunk = file.read(CHUNK_SIZE)
+            while chunk:
                 h.update(chunk)
+                chunk = file.read(CHUNK_SIZE)
         return h.hexdigest()
 
     def normalize_file_or_folder_name(self, filename: str) -> str:
-        return "".join(
-            [
-                char
-                if (char.isalnum() or char in self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTERS)
-                else self.NON_ALPHANUM_FILE_OR_FOLDER_NAME_CHARACTER_REPLACEMENT
-                for char in filename
-            ]
-        )
+        return filename.translate(self.file_or_folder_name_table)
 
     def print_error(self, link: str):
         print(
@@ -37,32 +78,57 @@ class MediafireDownloader:
             f"Take a look if you want to be sure: {link}"
         )
 
-    def main(self):
-        links_file = input("Please enter the file path containing Mediafire links: ").strip('"')
-        output_path = input("Please enter the output folder (default is current directory): ") or "."
-        threads_num = input("Please enter the number of threads to use (default is 10): ")
-        threads_num = int(threads_num) if threads_num else 10
-
-        links = self.extract_links_from_file(links_file)
+    def main(self, argv: list = None):
+        parser = argparse.ArgumentParser(description="Download files and folders from Mediafire")
+        parser.add_argument("--url", help="Mediafire file or folder link to download")
+        parser.add_argument("--links-file", help="file containing Mediafire links, one per line")
+        parser.add_argument("--output", help="output folder (default is current directory)")
+        parser.add_argument("--threads", type=int, help="number of threads to use (default is 10)")
+        args = parser.parse_args(argv)
+
+        if args.threads is not None and args.threads < 1:
+            parser.error("--threads must be at least 1")
+
+        interactive = sys.stdin.isatty()
+
+        links_file = args.links_file
+        if not args.url and not links_file:
+            if not interactive:
+                parser.error("--url or --links-file is required when stdin is not a terminal")
+            links_file = input("Please enter the file path containing Mediafire links: ").strip('"')
+
+        output_path = args.output
+        if output_path is None and interactive:
+            output_path = input("Please enter the output folder (default is current directory): ")
+        output_path = os.path.abspath(output_path or ".")
+
+        threads_num = args.threads
+        if threads_num is None and interactive:
+            threads_num = input("Please enter the number of threads to use (default is 10): ")
+            threads_num = int(threads_num) if threads_num else None
+            if threads_num is not None and threads_num < 1:
+                parser.error("the number of threads must be at least 1")
+        if threads_num is None:
+            threads_num = 10
+
+        links = [args.url] if args.url else []
+        if links_file:
+            links += self.extract_links_from_file(links_file)
 
         for mediafire_url in links:
-            folder_or_file = re.findall(
-                r"mediafire\.com/(folder|file|file_premium)/([a-zA-Z0-9]+)", mediafire_url
-            )
+            folder_or_file = MEDIAFIRE_LINK_REGEX.search(mediafire_url)
 
             if not folder_or_file:
                 print(f"Invalid link: {mediafire_url}")
                 continue
 
-            t, key = folder_or_file[0]
+            t, key = folder_or_file.groups()
 
             if t in {"file", "file_premium"}:
-                file_data = requests.get(self.get_info_endpoint(key)).json()["response"]["file_info"]
-
-                if output_path:
-                    os.chdir(output_path)
+                file_data = self.session.get(self.get_info_endpoint(key), timeout=REQUEST_TIMEOUT).json()["response"]["file_info"]
 
-                self.download_file(file_data)
+                os.makedirs(output_path, exist_ok=True)
+                self.download_file(file_data, dest_dir=output_path)
             elif t == "folder":
                 self.get_folders(key, output_path, threads_num, first=True)
             else:
@@ -77,8 +143,10 @@ class MediafireDownloader:
         links = [link.strip() for link in links if link.strip()]
         return links
 
+    @staticmethod
+    @lru_cache(maxsize=4096)
     def get_files_or_folders_api_endpoint(
-        self, filefolder: str, folder_key: str, chunk: int = 1, info: bool = False
+        filefolder: str, folder_key: str, chunk: int = 1, info: bool = False
     ) -> str:
         return (
             f"https://www.mediafire.com/api/1.4/folder"
@@ -87,100 +155,111 @@ class MediafireDownloader:
             f"&version=1.5&folder_key={folder_key}&response_format=json"
         )
 
-    def get_info_endpoint(self, file_key: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def get_info_endpoint(file_key: str) -> str:
         return f"https://www.mediafire.com/api/file/get_info.php?quick_key={file_key}&response_format=json"
 
     def get_folders(
-        self, folder_key: str, folder_name: str, threads_num: int, first: bool = False
+        self, folder_key: str, folder_path: str, threads_num: int, first: bool = False
     ) -> None:
         if first:
-            folder_name = os.path.join(
-                folder_name,
+            folder_path = os.path.join(
+                folder_path,
                 self.normalize_file_or_folder_name(
-                    requests.get(
-                        self.get_files_or_folders_api_endpoint("folder", folder_key, info=True)
+                    self.session.get(
+                        self.get_files_or_folders_api_endpoint("folder", folder_key, info=True),
+                        timeout=REQUEST_TIMEOUT,
                     ).json()["response"]["folder_info"]["name"]
                 ),
             )
 
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-        os.chdir(folder_name)
+        os.makedirs(folder_path, exist_ok=True)
 
-        self.download_folder(folder_key, threads_num)
+        self.download_folder(folder_key, threads_num, folder_path)
 
-        folder_content = requests.get(
-            self.get_files_or_folders_api_endpoint("folders", folder_key)
+        folder_content = self.session.get(
+            self.get_files_or_folders_api_endpoint("folders", folder_key),
+            timeout=REQUEST_TIMEOUT,
         ).json()["response"]["folder_content"]
 
         if "folders" in folder_content:
             for folder in folder_content["folders"]:
-                self.get_folders(folder["folderkey"], folder["name"], threads_num)
-                os.chdir("..")
+                self.get_folders(
+                    folder["folderkey"],
+                    os.path.join(folder_path, self.normalize_file_or_folder_name(folder["name"])),
+                    threads_num,
+                )
+
+    def download_folder(self, folder_key: str, threads_num: int, dest_dir: str = ".") -> None:
+        def get_chunk(chunk: int) -> dict:
+            return self.session.get(
+                self.get_files_or_folders_api_endpoint("files", folder_key, chunk=chunk),
+                timeout=REQUEST_TIMEOUT,
+            ).json()
 
-    def download_folder(self, folder_key: str, threads_num: int) -> None:
         data = []
         chunk = 1
         more_chunks = True
 
         try:
-            while more_chunks:
-                r_json = requests.get(
-                    self.get_files_or_folders_api_endpoint("files", folder_key, chunk=chunk)
-                ).json()
-                more_chunks = r_json["response"]["folder_content"]["more_chunks"] == "yes"
-                data += r_json["response"]["folder_content"]["files"]
-                chunk += 1
+            r_json = get_chunk(chunk)
+            more_chunks = r_json["response"]["folder_content"]["more_chunks"] == "yes"
+            data.extend(r_json["response"]["folder_content"]["files"])
+            chunk += 1
+
+            # The API doesn't report how many chunks there are, so fetch the
+            # next few concurrently and stop at the first one without more.
+            with ThreadPoolExecutor(max_workers=FOLDER_CHUNKS_BATCH_SIZE) as executor:
+                while more_chunks:
+                    for r_json in executor.map(get_chunk, range(chunk, chunk + FOLDER_CHUNKS_BATCH_SIZE)):
+                        more_chunks = r_json["response"]["folder_content"]["more_chunks"] == "yes"
+                        data.extend(r_json["response"]["folder_content"]["files"])
+                        if not more_chunks:
+                            break
+                    chunk += FOLDER_CHUNKS_BATCH_SIZE
 
         except KeyError:
             print("Invalid link")
             return
 
         event = threading.Event()
-        threadLimiter = threading.BoundedSemaphore(threads_num)
-        total_threads = []
-
-        for file in data:
-            total_threads.append(
-                threading.Thread(
-                    target=self.download_file,
-                    args=(
-                        file,
-                        event,
-                        threadLimiter,
-                    ),
-                )
-            )
-
-        for thread in total_threads:
-            thread.start()
+        executor = ThreadPoolExecutor(max_workers=threads_num)
+        futures = [executor.submit(self.download_file, file, event, dest_dir) for file in data]
 
         try:
-            while True:
-                if all(not t.is_alive() for t in total_threads):
-                    break
-                time.sleep(0.01)
+            for completed, future in enumerate(as_completed(futures), 1):
+                if future.exception():
+                    print(f"Error: {future.exception()}")
+                print(f"{completed}/{len(futures)} files done")
         except KeyboardInterrupt:
             print("Closing all threads")
             event.set()
-            for thread in total_threads:
-                thread.join()
+            executor.shutdown(wait=True, cancel_futures=True)
             print("Download interrupted")
-            exit(0)
+            sys.exit(0)
 
-    def download_file(self, file: dict, event: threading.Event = None, limiter: threading.BoundedSemaphore = None) -> None:
-        if limiter:
-            limiter.acquire()
+        executor.shutdown()
 
+    def download_file(
+        self,
+        file: dict,
+        event: threading.Event = None,
+        dest_dir: str = ".",
+    ) -> None:
         download_link = file["links"]["normal_download"]
 
         filename = self.normalize_file_or_folder_name(file["filename"])
+        file_path = os.path.join(dest_dir, filename)
 
-        if os.path.exists(filename):
-            if self.hash_file(filename) == file["hash"]:
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            st = None
+
+        if st is not None:
+            if st.st_size == int(file["size"]) and self.hash_file(file_path) == file["hash"]:
                 print(f"{filename} already exists, skipping")
-                if limiter:
-                    limiter.release()
                 return
             else:
                 print(f"{filename} already exists but corrupted, downloading again")
@@ -189,54 +268,68 @@ class MediafireDownloader:
 
         if event:
             if event.is_set():
-                if limiter:
-                    limiter.release()
                 return
 
         try:
-            if requests.head(download_link).headers.get("content-encoding") == "gzip":
-                html = requests.get(download_link).text
-                soup = gazpacho.Soup(html)
-                download_link = (
-                    soup.find("div", {"class": "download_link"})
-                    .find("a", {"class": "input popsok"})
-                    .attrs["href"]
-                )
+            # The normal download link either serves the file directly or an
+            # HTML page on www.mediafire.com holding the real link.
+            r = self.session.get(download_link, stream=True, timeout=REQUEST_TIMEOUT)
+            if (
+                urlsplit(r.url).hostname == "www.mediafire.com"
+                and "text/html" in r.headers.get("content-type", "")
+            ):
+                with r:
+                    body = r.content
+                download_button = DOWNLOAD_BUTTON_REGEX.search(body).group(0)
+                download_link = html.unescape(HREF_REGEX.search(download_button).group(1).decode())
+                r = self.session.get(download_link, stream=True, timeout=REQUEST_TIMEOUT)
         except Exception:
             self.print_error(download_link)
-            if limiter:
-                limiter.release()
             return
 
+        file_created = False
         try:
-            with requests.get(download_link, stream=True) as r:
+            with r:
                 r.raise_for_status()
-                with open(filename, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=4096):
+                r.raw.decode_content = True
+                h = hashlib.sha256()
+                size = 0 if r.headers.get("content-encoding") else int(r.headers.get("content-length", 0))
+                with open(file_path, "wb") as f:
+                    file_created = True
+                    if size and hasattr(os, "posix_fallocate"):
+                        try:
+                            os.posix_fallocate(f.fileno(), 0, size)
+                        except OSError:
+                            # Not supported by every filesystem; it's only an optimization.
+                            pass
+                    chunk = r.raw.read(CHUNK_SIZE)
+                    while chunk:
                         if event:
                             if event.is_set():
                                 break
-                        if chunk:
-                            f.write(chunk)
+                        f.write(chunk)
+                        h.update(chunk)
+                        chunk = r.raw.read(CHUNK_SIZE)
         except Exception as e:
             print(f"Error downloading {filename}: {str(e)}")
             self.print_error(download_link)
-            if limiter:
-                limiter.release()
+            if file_created:
+                os.remove(file_path)
+                print(f"Partially downloaded {filename} deleted")
             return
 
         if event:
             if event.is_set():
-                os.remove(filename)
+                os.remove(file_path)
                 print(f"Partially downloaded {filename} deleted")
-                if limiter:
-                    limiter.release()
                 return
 
-        print(f"{filename} downloaded")
+        if h.hexdigest() != file["hash"]:
+            os.remove(file_path)
+            print(f"{filename} downloaded but corrupted, deleted")
+            return
 
-        if limiter:
-            limiter.release()
+        print(f"{filename} downloaded")
 
 
 if __name__ == "__main__":
@@ -244,4 +337,4 @@ if __name__ == "__main__":
     try:
         downloader.main()
     except KeyboardInterrupt:
-        exit(0)
+        sys.exit(0)